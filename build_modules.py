@@ -1,3 +1,6 @@
+import copy
+import types
+
 import torch
 from torch.utils.data import DataLoader, DistributedSampler
 from torch.utils.data.sampler import BatchSampler, RandomSampler
@@ -31,12 +34,14 @@ def build_dataloader(args, dataset_name, domain, split, trans):
                                dataset_name=dataset_name,
                                domain=domain,
                                split=split,
-                               transforms=trans)
+                               transforms=trans,
+                               min_decode_size=args.min_decode_size)
     batch_sampler = build_sampler(args, dataset, split)
     data_loader = DataLoader(dataset=dataset,
                              batch_sampler=batch_sampler,
                              collate_fn=CocoStyleDataset.collate_fn,
-                             num_workers=args.num_workers)
+                             num_workers=args.num_workers,
+                             pin_memory=True)
     return data_loader
 
 
@@ -47,12 +52,14 @@ def build_dataloader_teaching(args, dataset_name, domain, split):
                                        split=split,
                                        weak_aug=weak_aug,
                                        strong_aug=strong_aug,
-                                       final_trans=base_trans)
+                                       final_trans=base_trans,
+                                       min_decode_size=args.min_decode_size)
     batch_sampler = build_sampler(args, dataset, split)
     data_loader = DataLoader(dataset=dataset,
                              batch_sampler=batch_sampler,
                              collate_fn=CocoStyleDatasetTeaching.collate_fn_teaching,
-                             num_workers=args.num_workers)
+                             num_workers=args.num_workers,
+                             pin_memory=True)
     return data_loader
 
 
@@ -82,10 +89,30 @@ def build_model(args, device):
         num_queries=args.num_queries,
         num_feature_levels=args.num_feature_levels
     )
+    if args.compile:
+        compile_model(model)
+    if args.channels_last:
+        # Only the 4D conv weights change layout, convolutions then also produce NHWC features
+        model.to(memory_format=torch.channels_last)
     model.to(device)
     return model
 
 
+def compile_model(model):
+    """
+    Compile the hot modules of the model in place. Input sizes change with the multi-scale augmentation.
+    """
+    # A chain of small elementwise kernels
+    model.position_encoding.compile(dynamic=True)
+    # Conv and group norm of each input projection
+    for input_proj in model.input_proj:
+        input_proj.compile(dynamic=True)
+    # Fuse the linear, activation, dropout, residual and layer norm chain of each FFN, the deformable attention
+    # itself is a custom CUDA op and is left eager. Bound explicitly, so a copied layer never reuses the original.
+    for layer in list(model.transformer.encoder.layers) + list(model.transformer.decoder.layers):
+        layer.forward_ffn = torch.compile(types.MethodType(type(layer).forward_ffn, layer), dynamic=True)
+
+
 def build_criterion(args, device, box_loss=True):
     criterion = SetCriterion(
         num_classes=args.num_classes,
@@ -125,9 +152,10 @@ def build_optimizer(args, model, enable_mae=False):
 
 
 def build_teacher(args, student_model, device):
-    teacher_model = build_model(args, device)
-    state_dict, student_state_dict = teacher_model.state_dict(), student_model.state_dict()
-    for key, value in state_dict.items():
-        state_dict[key] = student_state_dict[key].clone().detach()
-    teacher_model.load_state_dict(state_dict)
+    # Copy the student directly, instead of building and initializing a second model to overwrite it
+    teacher_model = copy.deepcopy(student_model)
+    if args.compile:
+        # The copied compiled functions are still bound to the student modules
+        compile_model(teacher_model)
+    teacher_model.to(device)
     return teacher_model
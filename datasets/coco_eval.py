@@ -2,6 +2,7 @@ import os
 import contextlib
 import copy
 import numpy as np
+import torch
 
 from pycocotools.cocoeval import COCOeval
 from pycocotools.coco import COCO
@@ -14,6 +15,8 @@ class CocoEval(COCOeval):
 
     def __init__(self, coco_gt=None, coco_dt=None, iou_type='bbox'):
         super(CocoEval, self).__init__(coco_gt, coco_dt, iou_type)
+        self.dt_arrays = {}
+        self.gt_arrays = {}
 
     def evaluate(self):
         p = self.params
@@ -24,6 +27,8 @@ class CocoEval(COCOeval):
         self.params = p
         self._prepare()
         cat_ids = p.catIds if p.useCats else [-1]
+        self.dt_arrays = {}
+        self.gt_arrays = {}
         self.ious = {
             (imgId, catId): self.computeIoU(imgId, catId)
             for imgId in p.imgIds
@@ -39,6 +44,143 @@ class CocoEval(COCOeval):
         self._paramsEval = copy.deepcopy(self.params)
         return p.imgIds, eval_imgs
 
+    def computeIoU(self, imgId, catId):
+        p = self.params
+        if p.iouType != 'bbox':
+            return super(CocoEval, self).computeIoU(imgId, catId)
+        gt = self.get_gt_arrays(imgId, catId)
+        dt = self.get_dt_arrays(imgId, catId)
+        if len(gt['ids']) == 0 or len(dt['ids']) == 0:
+            return []
+        return self.box_overlaps(dt['boxes'].copy(), gt['boxes'].copy(), gt['iscrowd'])
+
+    def evaluateImg(self, imgId, catId, aRng, maxDet):
+        p = self.params
+        gt = self.get_gt_arrays(imgId, catId)
+        dt = {k: v[0:maxDet] for k, v in self.get_dt_arrays(imgId, catId).items()}
+        if len(gt['ids']) == 0 and len(dt['ids']) == 0:
+            return None
+        gt_ig = (gt['ignore'] | (gt['area'] < aRng[0]) | (gt['area'] > aRng[1])).astype(np.int64)
+        # sort gt ignore last, dt are already sorted highest score first
+        gtind = np.argsort(gt_ig, kind='mergesort')
+        gt_ig, gt_ids, iscrowd = gt_ig[gtind], gt['ids'][gtind], gt['iscrowd'][gtind]
+        ious = self.ious[imgId, catId][:, gtind] if len(self.ious[imgId, catId]) > 0 else self.ious[imgId, catId]
+        num_thrs, num_gt, num_dt = len(p.iouThrs), len(gt_ids), len(dt['ids'])
+        gtm = np.zeros((num_thrs, num_gt))
+        dtm = np.zeros((num_thrs, num_dt))
+        dt_ig = np.zeros((num_thrs, num_dt))
+        # gt are sorted with ignored ones last, a regular match is always preferred to an ignored one
+        num_regular = num_gt - int(gt_ig.sum())
+        if not len(ious) == 0:
+            # All thresholds are matched at once: [T, D] index of the matched gt, -1 if none
+            thrs = np.minimum(p.iouThrs, 1 - 1e-10)
+            tinds = np.arange(num_thrs)
+            matches = np.full((num_thrs, num_dt), -1)
+            # Per threshold overlaps, a matched non-crowd gt is set to -1 for the following detections
+            overlaps = np.repeat(ious[None], num_thrs, 0)
+            has_crowd = iscrowd.any()
+            # Detections without any overlap above the lowest threshold never match
+            for dind in np.nonzero(ious.max(1) >= thrs.min())[0]:
+                rows = overlaps[:, dind]
+                if num_regular == 0 or num_regular == num_gt:
+                    m = self._best_match(rows, thrs)
+                else:
+                    m = self._best_match(rows[:, :num_regular], thrs)
+                    m_ig = self._best_match(rows[:, num_regular:], thrs)
+                    m = np.where((m == -1) & (m_ig != -1), m_ig + num_regular, m)
+                matches[:, dind] = m
+                tind, m = tinds[m != -1], m[m != -1]
+                if has_crowd:
+                    tind, m = tind[~iscrowd[m]], m[~iscrowd[m]]
+                overlaps[tind, dind + 1:, m] = -1
+            # Row-major order, a crowd gt matched by several detections keeps the last one as in pycocotools
+            tind, dind = np.nonzero(matches != -1)
+            m = matches[tind, dind]
+            dt_ig[tind, dind] = gt_ig[m]
+            dtm[tind, dind] = gt_ids[m]
+            gtm[tind, m] = dt['ids'][dind]
+        # set unmatched detections outside of area range to ignore
+        a = ((dt['area'] < aRng[0]) | (dt['area'] > aRng[1])).reshape((1, num_dt))
+        dt_ig = np.logical_or(dt_ig, np.logical_and(dtm == 0, np.repeat(a, num_thrs, 0)))
+        return {
+            'image_id': imgId,
+            'category_id': catId,
+            'aRng': aRng,
+            'maxDet': maxDet,
+            'dtIds': dt['ids'].tolist(),
+            'gtIds': gt_ids.tolist(),
+            'dtMatches': dtm,
+            'gtMatches': gtm,
+            'dtScores': dt['scores'].tolist(),
+            'gtIgnore': gt_ig,
+            'dtIgnore': dt_ig,
+        }
+
+    @staticmethod
+    def _best_match(rows, thrs):
+        """
+        Index of the best overlap >= thr in each row of a [T, G] array, -1 if none.
+        Ties resolve to the last index, as in the sequential scan of pycocotools.
+        """
+        m = rows.shape[1] - 1 - np.argmax(rows[:, ::-1], axis=1)
+        return np.where(rows[np.arange(len(rows)), m] >= thrs, m, -1)
+
+    def get_dt_arrays(self, imgId, catId):
+        """
+        Detections of one image and category as arrays of boxes, ids, areas and scores, sorted by score and
+        truncated to the largest maxDets once and shared by computeIoU and all area ranges of evaluateImg.
+        """
+        if (imgId, catId) not in self.dt_arrays:
+            p = self.params
+            dt = self._dts[imgId, catId] if p.useCats else [d for cId in p.catIds for d in self._dts[imgId, cId]]
+            scores = np.fromiter((d['score'] for d in dt), dtype=np.float64, count=len(dt))
+            inds = np.argsort(-scores, kind='mergesort')[:p.maxDets[-1]]
+            dt = [dt[i] for i in inds]
+            self.dt_arrays[imgId, catId] = {
+                'boxes': np.array([d['bbox'] for d in dt], dtype=np.float64).reshape(-1, 4),
+                'ids': np.array([d['id'] for d in dt], dtype=np.int64),
+                'area': np.array([d['area'] for d in dt], dtype=np.float64),
+                'scores': scores[inds],
+            }
+        return self.dt_arrays[imgId, catId]
+
+    def get_gt_arrays(self, imgId, catId):
+        """
+        Ground truths of one image and category as arrays of boxes, ids, areas, crowd and ignore flags,
+        built once and shared by computeIoU and all area ranges of evaluateImg.
+        """
+        if (imgId, catId) not in self.gt_arrays:
+            p = self.params
+            gt = self._gts[imgId, catId] if p.useCats else [g for cId in p.catIds for g in self._gts[imgId, cId]]
+            self.gt_arrays[imgId, catId] = {
+                'boxes': np.array([g['bbox'] for g in gt], dtype=np.float64).reshape(-1, 4),
+                'ids': np.array([g['id'] for g in gt], dtype=np.int64),
+                'area': np.array([g['area'] for g in gt], dtype=np.float64),
+                'iscrowd': np.array([g['iscrowd'] for g in gt], dtype=bool),
+                'ignore': np.array([g['ignore'] for g in gt], dtype=bool),
+            }
+        return self.gt_arrays[imgId, catId]
+
+    @staticmethod
+    def box_overlaps(dt_boxes, gt_boxes, iscrowd):
+        """
+        Pairwise overlaps between [x, y, w, h] boxes, computed for the whole [D, G] matrix at once.
+        Same as pycocotools: IoU for regular ground truths, intersection over detection area for crowd ones.
+        """
+        dt_area = dt_boxes[:, 2] * dt_boxes[:, 3]
+        gt_area = gt_boxes[:, 2] * gt_boxes[:, 3]
+        dt_boxes[:, 2:] += dt_boxes[:, :2]
+        gt_boxes[:, 2:] += gt_boxes[:, :2]
+        # [D, G, 2] intersection width and height, computed in place
+        lt = np.maximum(dt_boxes[:, None, :2], gt_boxes[None, :, :2])
+        wh = np.minimum(dt_boxes[:, None, 2:], gt_boxes[None, :, 2:])
+        wh -= lt
+        np.clip(wh, 0, None, out=wh)
+        inter = wh[..., 0] * wh[..., 1]
+        union = dt_area[:, None] + np.where(iscrowd, 0.0, gt_area)[None, :]
+        union -= np.where(iscrowd[None, :], 0.0, inter)
+        return np.divide(inter, union, out=np.zeros_like(inter), where=inter > 0)
+
     def summarize_ap(self, if_print=True):
 
         def _summarize(iou_thr=None, area_rng='all', max_dets=100):
@@ -106,19 +248,19 @@ class CocoEvaluator:
 
     @staticmethod
     def prepare_for_coco_detection(predictions):
-        coco_results = []
-        for original_id, prediction in predictions.items():
-            if len(prediction) == 0:
-                continue
-            boxes = prediction["boxes"]
-            boxes = convert_to_xywh(boxes).tolist()
-            scores = prediction["scores"].tolist()
-            labels = prediction["labels"].tolist()
-            coco_results.extend([
-                {"image_id": original_id, "category_id": labels[k], "bbox": box, "score": scores[k]}
-                for k, box in enumerate(boxes)
-            ])
-        return coco_results
+        predictions = {k: v for k, v in predictions.items() if len(v) > 0}
+        if len(predictions) == 0:
+            return []
+        # One device to host transfer per field for the whole batch, instead of one per image
+        boxes = torch.cat([convert_to_xywh(prediction["boxes"]) for prediction in predictions.values()]).tolist()
+        scores = torch.cat([prediction["scores"] for prediction in predictions.values()]).tolist()
+        labels = torch.cat([prediction["labels"] for prediction in predictions.values()]).tolist()
+        image_ids = [original_id for original_id, prediction in predictions.items()
+                     for _ in range(len(prediction["scores"]))]
+        return [
+            {"image_id": image_id, "category_id": label, "bbox": box, "score": score}
+            for image_id, label, box, score in zip(image_ids, labels, boxes, scores)
+        ]
 
     @staticmethod
     def merge(img_ids, eval_imgs):
@@ -1,6 +1,9 @@
 import os
+import math
 
+import numpy as np
 import torch
+from PIL import Image
 from torchvision.datasets.coco import CocoDetection
 from typing import Optional, Callable
 
@@ -81,39 +84,90 @@ class CocoStyleDataset(CocoDetection):
                  dataset_name: str,
                  domain: str,
                  split: str,
-                 transforms: Optional[Callable] = None):
+                 transforms: Optional[Callable] = None,
+                 min_decode_size: int = 0):
         # dataset_root = os.path.join(root_dir, dataset_name)
         img_dir = os.path.join(root_dir, self.img_dirs[dataset_name][split])
         self.anno_file = os.path.join(root_dir, self.anno_files[dataset_name][domain][split])
         super(CocoStyleDataset, self).__init__(root=img_dir, annFile=self.anno_file, transforms=transforms)
         self.split = split
+        self.min_decode_size = min_decode_size
+        self.build_annotation_arrays()
+        # Training only reads the arrays above, the pycocotools index is kept for evaluation
+        if split == 'train':
+            del self.coco
+
+    def build_annotation_arrays(self):
+        """
+        Flatten file names and non-crowd annotations into numpy arrays ordered like self.ids.
+        Dataloader workers forked from the main process share these buffers, whereas reading the
+        python objects of pycocotools touches their refcounts and copies the pages into every worker.
+        Boxes are converted to xyxy here once, they are clipped to the decoded image size when loaded.
+        """
+        images = self.coco.imgs
+        annotations = [obj for obj in self.coco.dataset.get('annotations', []) if obj.get('iscrowd', 0) == 0]
+        self.file_names = np.asarray([images[img_id]['file_name'] for img_id in self.ids])
+        # Group annotations by image, keeping their order in the annotation file
+        anno_img_ids = np.asarray([obj['image_id'] for obj in annotations], dtype=np.int64)
+        order = np.argsort(anno_img_ids, kind='stable')
+        img_ids = np.asarray(self.ids, dtype=np.int64)
+        starts = np.searchsorted(anno_img_ids[order], img_ids, side='left')
+        counts = np.searchsorted(anno_img_ids[order], img_ids, side='right') - starts
+        self.anno_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        index = order[np.repeat(starts - self.anno_offsets[:-1], counts) + np.arange(self.anno_offsets[-1])]
+        self.anno_boxes = np.asarray([annotations[i]['bbox'] for i in index], dtype=np.float32).reshape(-1, 4)
+        self.anno_boxes[:, 2:] += self.anno_boxes[:, :2]
+        self.anno_labels = np.asarray([annotations[i]['category_id'] for i in index], dtype=np.int64)
+
+    def load_image(self, idx):
+        """
+        Load an image and its original (width, height).
+        With min_decode_size > 0, JPEGs are downscaled by the decoder itself (1/2, 1/4 or 1/8)
+        as long as the shorter edge stays >= min_decode_size, which is much cheaper than decoding
+        large images at full resolution and resizing them afterwards.
+        """
+        image = Image.open(os.path.join(self.root, self.file_names[idx]))
+        orig_size = image.size
+        if self.min_decode_size > 0:
+            scale = self.min_decode_size / min(orig_size)
+            image.draft('RGB', (math.ceil(orig_size[0] * scale), math.ceil(orig_size[1] * scale)))
+        return image.convert('RGB'), orig_size
+
+    def load_annotation(self, idx, w, h):
+        """
+        xyxy boxes and labels of an image, clipped to its decoded (w, h) and without the boxes left empty.
+        """
+        start, end = self.anno_offsets[idx], self.anno_offsets[idx + 1]
+        boxes = self.anno_boxes[start:end].copy()
+        np.clip(boxes[:, 0::2], 0, w, out=boxes[:, 0::2])
+        np.clip(boxes[:, 1::2], 0, h, out=boxes[:, 1::2])
+        keep = (boxes[:, 3] > boxes[:, 1]) & (boxes[:, 2] > boxes[:, 0])
+        return {'boxes': boxes[keep], 'labels': self.anno_labels[start:end][keep]}
 
     @staticmethod
-    def convert(image_id, image, annotation):
+    def convert(image_id, image, annotation, orig_size=None):
+        """
+        Wrap a clipped annotation into tensors.
+        Boxes are given in orig_size and rescaled if the image was decoded at a smaller size.
+        """
         w, h = image.size
-        anno = [obj for obj in annotation if 'iscrowd' not in obj or obj['iscrowd'] == 0]
-        boxes = [obj["bbox"] for obj in anno]
-        boxes = torch.as_tensor(boxes, dtype=torch.float32).reshape(-1, 4)
-        boxes[:, 2:] += boxes[:, :2]
-        boxes[:, 0::2].clamp_(min=0, max=w)
-        boxes[:, 1::2].clamp_(min=0, max=h)
-        classes = [obj["category_id"] for obj in anno]
-        classes = torch.tensor(classes, dtype=torch.int64)
-        keep = (boxes[:, 3] > boxes[:, 1]) & (boxes[:, 2] > boxes[:, 0])
+        orig_w, orig_h = (w, h) if orig_size is None else orig_size
+        boxes = torch.from_numpy(annotation['boxes'])
+        if (orig_w, orig_h) != (w, h):
+            boxes = boxes * torch.as_tensor([w / orig_w, h / orig_h, w / orig_w, h / orig_h])
         new_annotation = {
-            'boxes': boxes[keep],
-            'labels': classes[keep],
+            'boxes': boxes,
+            'labels': torch.from_numpy(annotation['labels']),
             'image_id': torch.as_tensor([image_id]),
-            'orig_size': torch.as_tensor([int(h), int(w)]),
+            'orig_size': torch.as_tensor([int(orig_h), int(orig_w)]),
             'size': torch.as_tensor([int(h), int(w)])
         }
         return image, new_annotation
 
     def __getitem__(self, idx):
         image_id = self.ids[idx]
-        image = self._load_image(image_id)
-        annotation = self._load_target(image_id)
-        image, annotation = self.convert(image_id, image, annotation)
+        image, orig_size = self.load_image(idx)
+        image, annotation = self.convert(image_id, image, self.load_annotation(idx, *orig_size), orig_size)
         if self.transforms is not None:
             image, annotation = self.transforms(image, annotation)
         return image, annotation
@@ -143,9 +197,27 @@ class CocoStyleDataset(CocoDetection):
         """
         image_list = [sample[0] for sample in batch]
         batched_images, masks = CocoStyleDataset.pad_mask(image_list)
-        annotations = [sample[1] for sample in batch]
+        annotations = CocoStyleDataset.batch_annotations([sample[1] for sample in batch])
         return batched_images, masks, annotations
 
+    @staticmethod
+    def batch_annotations(annotations):
+        """
+        Concatenate each annotation field over the batch, so the dataloader pins it and it is copied to the
+        device as one tensor. Returns the batched fields and the per-image sizes to split them again.
+        """
+        keys = list(annotations[0].keys()) if len(annotations) > 0 else []
+        sizes = {k: [len(t[k]) for t in annotations] for k in keys}
+        return {k: torch.cat([t[k] for t in annotations]) for k in keys}, sizes
+
+    @staticmethod
+    def split_annotations(batched, sizes):
+        """
+        Per-image annotations as views of the batched fields.
+        """
+        keys = list(batched.keys())
+        return [dict(zip(keys, values)) for values in zip(*[batched[k].split(sizes[k]) for k in keys])]
+
 
 class CocoStyleDatasetTeaching(CocoStyleDataset):
 
@@ -156,8 +228,9 @@ class CocoStyleDatasetTeaching(CocoStyleDataset):
                  split: str,
                  weak_aug: Callable,
                  strong_aug: Callable,
-                 final_trans: Callable):
-        super(CocoStyleDatasetTeaching, self).__init__(root_dir, dataset_name, domain, split, None)
+                 final_trans: Callable,
+                 min_decode_size: int = 0):
+        super(CocoStyleDatasetTeaching, self).__init__(root_dir, dataset_name, domain, split, None, min_decode_size)
         self.weak_aug = weak_aug
         self.strong_aug = strong_aug
         self.final_trans = final_trans
@@ -177,14 +250,14 @@ class CocoStyleDatasetTeaching(CocoStyleDataset):
         batch: [sample_{i} for i in range(batch_size)]
             sample_{i}: (teacher_image, student_image, annotation)
         """
-        teacher_image_list = [sample[0] for sample in batch]
-        batched_teacher_images, teacher_masks = CocoStyleDataset.pad_mask(teacher_image_list)
-        student_image_list = [sample[1] for sample in batch]
-        batched_student_images, student_masks = CocoStyleDataset.pad_mask(student_image_list)
-        annotations = [sample[2] for sample in batch]
-        batched_images = torch.stack([batched_teacher_images, batched_student_images], dim=0)
-        assert teacher_masks.equal(student_masks)
-        return batched_images, teacher_masks, annotations
+        batch_size = len(batch)
+        # Pad teacher and student images into one buffer, viewed as [2, B, C, H, W] without a stack copy
+        image_list = [sample[0] for sample in batch] + [sample[1] for sample in batch]
+        batched_images, masks = CocoStyleDataset.pad_mask(image_list)
+        batched_images = batched_images.view(2, batch_size, *batched_images.shape[1:])
+        annotations = CocoStyleDataset.batch_annotations([sample[2] for sample in batch])
+        assert masks[:batch_size].equal(masks[batch_size:])
+        return batched_images, masks[:batch_size], annotations
 
 
 class DataPreFetcher:
@@ -196,15 +269,32 @@ class DataPreFetcher:
         self.next_masks = None
         self.next_annotations = None
         self.stream = torch.cuda.Stream()
+        self.copy_done = None
         self.preload()
 
     def to_cuda(self):
-        self.next_images = self.next_images.to(self.device, non_blocking=True)
-        self.next_masks = self.next_masks.to(self.device, non_blocking=True)
-        self.next_annotations = [
-            {k: v.to(self.device, non_blocking=True) for k, v in t.items()}
-            for t in self.next_annotations
-        ]
+        """
+        Allocate the device tensors on the compute stream and fill them on the side stream.
+        Their memory belongs to the compute stream, so it can use them without record_stream
+        once it has waited on the copy_done event.
+        """
+        compute_stream = torch.cuda.current_stream()
+        images = torch.empty_like(self.next_images, device=self.device)
+        masks = torch.empty_like(self.next_masks, device=self.device)
+        # Annotations are batched and pinned per field by the dataloader, one transfer per field
+        batched, sizes = self.next_annotations
+        batched_cuda = {k: torch.empty_like(v, device=self.device) for k, v in batched.items()}
+        with torch.cuda.stream(self.stream):
+            # The allocated blocks may still be in use by kernels queued on the compute stream
+            self.stream.wait_stream(compute_stream)
+            images.copy_(self.next_images, non_blocking=True)
+            masks.copy_(self.next_masks, non_blocking=True)
+            for k, v in batched_cuda.items():
+                v.copy_(batched[k], non_blocking=True)
+            self.copy_done = torch.cuda.Event()
+            self.copy_done.record(self.stream)
+        annotations = CocoStyleDataset.split_annotations(batched_cuda, sizes)
+        self.next_images, self.next_masks, self.next_annotations = images, masks, annotations
 
     def preload(self):
         try:
@@ -214,20 +304,11 @@ class DataPreFetcher:
             self.next_masks = None
             self.next_annotations = None
             return
-        with torch.cuda.stream(self.stream):
-            self.to_cuda()
+        self.to_cuda()
 
     def next(self):
-        torch.cuda.current_stream().wait_stream(self.stream)
+        if self.copy_done is not None:
+            torch.cuda.current_stream().wait_event(self.copy_done)
         images, masks, annotations = self.next_images, self.next_masks, self.next_annotations
-        if images is not None:
-            self.next_images.record_stream(torch.cuda.current_stream())
-        if masks is not None:
-            self.next_masks.record_stream(torch.cuda.current_stream())
-        if annotations is not None:
-            for anno in self.next_annotations:
-                for k, v in anno.items():
-                    v.record_stream(torch.cuda.current_stream())
         self.preload()
         return images, masks, annotations
-
@@ -101,7 +101,9 @@ class RandomHorizontalFlipImgAnno(tv_trans.RandomHorizontalFlip):
             if annotation is not None:
                 width, height = image.size
                 boxes = new_annotation["boxes"]
-                boxes = boxes[:, [2, 1, 0, 3]] * torch.as_tensor([-1, 1, -1, 1]) + torch.as_tensor([width, 0, width, 0])
+                # Swap x1 and x2 (the indexing returns a copy) and mirror them in place, no constant tensors per call
+                boxes = boxes[:, [2, 1, 0, 3]]
+                boxes[:, 0::2] = width - boxes[:, 0::2]
                 new_annotation["boxes"] = boxes
         return image, new_annotation
 
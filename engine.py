@@ -4,7 +4,7 @@ import json
 import torch
 from torch.utils.data import DataLoader
 
-from datasets.coco_style_dataset import DataPreFetcher
+from datasets.coco_style_dataset import CocoStyleDataset, DataPreFetcher
 from datasets.coco_eval import CocoEvaluator
 
 from models.criterion import post_process, get_pseudo_labels
@@ -14,6 +14,17 @@ from collections import defaultdict
 from typing import List
 
 
+def mean_loss_dict(loss_dict, num_iters):
+    """
+    Average the loss sums accumulated on device over an epoch, copying all of them to the host at once.
+    """
+    keys = list(loss_dict.keys())
+    if len(keys) == 0:
+        return defaultdict(float)
+    values = torch.stack([loss_dict[k].reshape(()) for k in keys]) / num_iters
+    return defaultdict(float, zip(keys, values.tolist()))
+
+
 def train_one_epoch_standard(model: torch.nn.Module,
                              criterion: torch.nn.Module,
                              data_loader: DataLoader,
@@ -43,9 +54,10 @@ def train_one_epoch_standard(model: torch.nn.Module,
             torch.nn.utils.clip_grad_norm_(model.parameters(), clip_max_norm)
         optimizer.step()
         # Record loss
-        epoch_loss += loss
+        # Kept on device, copied to the host once at the end of the epoch
+        epoch_loss += loss.detach()
         for k, v in loss_dict.items():
-            epoch_loss_dict[k] += v.detach().cpu().item()
+            epoch_loss_dict[k] += v.detach()
         # Data pre-fetch
         images, masks, annotations = fetcher.next()
         # Log
@@ -54,8 +66,7 @@ def train_one_epoch_standard(model: torch.nn.Module,
                   'total loss: ' + str(loss.detach().cpu().numpy()), flush=flush)
     # Final process of training statistic
     epoch_loss /= len(data_loader)
-    for k, v in epoch_loss_dict.items():
-        epoch_loss_dict[k] /= len(data_loader)
+    epoch_loss_dict = mean_loss_dict(epoch_loss_dict, len(data_loader))
     end_time = time.time()
     total_time_str = str(datetime.timedelta(seconds=int(end_time - start_time)))
     print('Training epoch ' + str(epoch) + ' finished. Time cost: ' + total_time_str +
@@ -92,12 +103,12 @@ def train_one_epoch_with_mae(model: torch.nn.Module,
         # Source forward
         out = model(source_images, source_masks)
         # Target forward
-        out_mae = model(target_images, target_masks, enable_mae=True, mask_ratio=mask_ratio)
+        out_mae = model(target_images, target_masks, enable_mae=True, mask_ratio=mask_ratio, mae_only=True)
         # Loss
         loss, loss_dict = criterion(out, source_annotations)
-        loss_mae, loss_dict_mae = criterion_mae(out_mae, enable_mae=True)
-        loss += loss_mae * coef_target
-        loss_dict['loss_mae'] = loss_dict_mae['loss_mae']
+        loss_mae = criterion_mae.loss_mae(out_mae)
+        loss += criterion_mae.coef_mae * loss_mae * coef_target
+        loss_dict['loss_mae'] = loss_mae
         # Backward
         optimizer.zero_grad()
         loss.backward()
@@ -105,9 +116,10 @@ def train_one_epoch_with_mae(model: torch.nn.Module,
             torch.nn.utils.clip_grad_norm_(model.parameters(), clip_max_norm)
         optimizer.step()
         # Record loss
-        epoch_loss += loss
+        # Kept on device, copied to the host once at the end of the epoch
+        epoch_loss += loss.detach()
         for k, v in loss_dict.items():
-            epoch_loss_dict[k] += v.detach().cpu().item()
+            epoch_loss_dict[k] += v.detach()
         # Data pre-fetch
         source_images, source_masks, source_annotations = source_fetcher.next()
         target_images, target_masks, _ = target_fetcher.next()
@@ -117,8 +129,7 @@ def train_one_epoch_with_mae(model: torch.nn.Module,
                   str(total_iters) + ' ] ' + 'total loss: ' + str(loss.detach().cpu().numpy()), flush=flush)
     # Final process of training statistic
     epoch_loss /= total_iters
-    for k, v in epoch_loss_dict.items():
-        epoch_loss_dict[k] /= total_iters
+    epoch_loss_dict = mean_loss_dict(epoch_loss_dict, total_iters)
     end_time = time.time()
     total_time_str = str(datetime.timedelta(seconds=int(end_time - start_time)))
     print('Cross-domain MAE training epoch ' + str(epoch) + ' finished. Time cost: ' + total_time_str +
@@ -163,10 +174,12 @@ def train_one_epoch_teaching(student_model: torch.nn.Module,
         # Source forward
         source_out = student_model(source_images, source_masks)
         source_loss, source_loss_dict = criterion(source_out, source_annotations, domain_label=0)
-        # Target teacher forward
-        with torch.no_grad():
+        # Target teacher forward, without autograd bookkeeping. Pseudo labels are cloned out of inference mode as
+        # they are used as loss targets.
+        with torch.inference_mode():
             teacher_out = teacher_model(target_teacher_images, target_masks)
             pseudo_labels = get_pseudo_labels(teacher_out['logits_all'][-1], teacher_out['boxes_all'][-1], thresholds)
+        pseudo_labels = [{k: v.clone() for k, v in label.items()} for label in pseudo_labels]
         # Target student forward
         target_student_out = student_model(target_student_images, target_masks, enable_mae, mask_ratio)
         target_loss, target_loss_dict = criterion_pseudo(target_student_out, pseudo_labels, 1, enable_mae)
@@ -178,12 +191,13 @@ def train_one_epoch_teaching(student_model: torch.nn.Module,
             torch.nn.utils.clip_grad_norm_(student_model.parameters(), clip_max_norm)
         optimizer.step()
         # Record epoch losses
-        epoch_loss += loss
+        # Kept on device, copied to the host once at the end of the epoch
+        epoch_loss += loss.detach()
         # update loss_dict
         for k, v in source_loss_dict.items():
-            epoch_source_loss_dict[k] += v.detach().cpu().item()
+            epoch_source_loss_dict[k] += v.detach()
         for k, v in target_loss_dict.items():
-            epoch_target_loss_dict[k] += v.detach().cpu().item()
+            epoch_target_loss_dict[k] += v.detach()
         # EMA update teacher
         with torch.no_grad():
             state_dict, student_state_dict = teacher_model.state_dict(), student_model.state_dict()
@@ -201,10 +215,8 @@ def train_one_epoch_teaching(student_model: torch.nn.Module,
                   'total loss: ' + str(loss.detach().cpu().numpy()), flush=flush)
     # Final process of loss dict
     epoch_loss /= total_iters
-    for k, v in epoch_source_loss_dict.items():
-        epoch_source_loss_dict[k] /= total_iters
-    for k, v in epoch_target_loss_dict.items():
-        epoch_target_loss_dict[k] /= total_iters
+    epoch_source_loss_dict = mean_loss_dict(epoch_source_loss_dict, total_iters)
+    epoch_target_loss_dict = mean_loss_dict(epoch_target_loss_dict, total_iters)
     end_time = time.time()
     total_time_str = str(datetime.timedelta(seconds=int(end_time - start_time)))
     print('Teaching epoch ' + str(epoch) + ' finished. Time cost: ' + total_time_str +
@@ -230,34 +242,36 @@ def evaluate(model: torch.nn.Module,
     else:
         raise ValueError('Unsupported dataset type.')
     epoch_loss = 0.0
-    for i, (images, masks, annotations) in enumerate(data_loader_val):
+    for i, (images, masks, (annotations, sizes)) in enumerate(data_loader_val):
+        # Checked on the host, the model then reuses its cached position encodings without a device sync
+        unpadded = not masks.any()
         # To CUDA
         images = images.to(device)
         masks = masks.to(device)
-        annotations = [{k: v.to(device) for k, v in t.items()} for t in annotations]
+        annotations = CocoStyleDataset.split_annotations({k: v.to(device) for k, v in annotations.items()}, sizes)
         # Forward
-        out = model(images, masks)
+        out = model(images, masks, unpadded=unpadded)
         logits_all, boxes_all = out['logits_all'], out['boxes_all']
         # Get pseudo labels
         if output_result_labels:
             results = get_pseudo_labels(logits_all[-1], boxes_all[-1], [0.4 for _ in range(9)])
-            for anno, res in zip(annotations, results):
-                image_id = anno['image_id'].item()
-                orig_image_size = anno['orig_size']
-                img_h, img_w = orig_image_size.unbind(0)
-                scale_fct = torch.stack([img_w, img_h, img_w, img_h])
-                converted_boxes = convert_to_xywh(box_cxcywh_to_xyxy(res['boxes'] * scale_fct))
-                converted_boxes = converted_boxes.detach().cpu().numpy().tolist()
-                for label, box in zip(res['labels'].detach().cpu().numpy().tolist(), converted_boxes):
-                    pseudo_anno = {
-                        'id': 0,
-                        'image_id': image_id,
-                        'category_id': label,
-                        'iscrowd': 0,
-                        'area': box[-2] * box[-1],
-                        'bbox': box
-                    }
-                    dataset_annotations[image_id].append(pseudo_anno)
+            # Scale and convert the boxes of the whole batch on device, then copy each field to the host once
+            scaled_boxes = torch.cat([res['boxes'] * anno['orig_size'][[1, 0, 1, 0]]
+                                      for anno, res in zip(annotations, results)])
+            converted_boxes = convert_to_xywh(box_cxcywh_to_xyxy(scaled_boxes)).tolist()
+            labels = torch.cat([res['labels'] for res in results]).tolist()
+            box_image_ids = torch.cat([anno['image_id'].expand(len(res['labels']))
+                                       for anno, res in zip(annotations, results)]).tolist()
+            for image_id, label, box in zip(box_image_ids, labels, converted_boxes):
+                pseudo_anno = {
+                    'id': 0,
+                    'image_id': image_id,
+                    'category_id': label,
+                    'iscrowd': 0,
+                    'area': box[-2] * box[-1],
+                    'bbox': box
+                }
+                dataset_annotations[image_id].append(pseudo_anno)
         # Loss
         loss, loss_dict = criterion(out, annotations)
         epoch_loss += loss
@@ -267,7 +281,8 @@ def evaluate(model: torch.nn.Module,
         # mAP
         orig_image_sizes = torch.stack([anno['orig_size'] for anno in annotations], dim=0)
         results = post_process(logits_all[-1], boxes_all[-1], orig_image_sizes, 100)
-        results = {anno['image_id'].item(): res for anno, res in zip(annotations, results)}
+        image_ids = torch.cat([anno['image_id'] for anno in annotations]).tolist()
+        results = {image_id: res for image_id, res in zip(image_ids, results)}
         evaluator.update(results)
     evaluator.synchronize_between_processes()
     evaluator.accumulate()
@@ -52,6 +52,9 @@ def get_args_parser(parser):
     parser.add_argument('--data_root', default='./data', type=str)
     parser.add_argument('--source_dataset', default='cityscapes', type=str)
     parser.add_argument('--target_dataset', default='foggy_cityscapes', type=str)
+    parser.add_argument('--min_decode_size', default=0, type=int,
+                        help='decode JPEGs at a reduced scale keeping the shorter edge >= this size, 0 to disable. '
+                             'Should not be smaller than the largest resize in the augmentations (800).')
     # Retraining parameters
     parser.add_argument('--epoch_retrain', default=40, type=int)
     parser.add_argument('--keep_modules', default=["decoder"], type=str, nargs="+")
@@ -76,6 +79,8 @@ def get_args_parser(parser):
     parser.add_argument('--num_workers', default=8, type=int)
     parser.add_argument('--print_freq', default=20, type=int)
     parser.add_argument('--flush', default=True, type=bool)
+    parser.add_argument('--compile', default=False, type=bool, help='compile hot modules with torch.compile (torch>=2.2)')
+    parser.add_argument('--channels_last', default=False, type=bool, help='run the convolutions in NHWC memory format')
     parser.add_argument("--resume", default="", type=str)
 
 
@@ -325,6 +330,8 @@ def eval_only(model, device):
     if args.distributed:
         Warning('Evaluation with distributed mode may cause error in output result labels.')
     criterion = build_criterion(args, device)
+    # Nothing is trained or saved, frozen batch norms can be folded into the backbone convolutions
+    model.backbone.fuse_conv_bn()
     # Eval source or target dataset
     val_loader = build_dataloader(args, args.target_dataset, 'target', 'val', val_trans)
     ap50_per_class, epoch_loss_val, coco_data = evaluate(
@@ -361,7 +368,7 @@ def main():
     device = torch.device(args.device)
     model = build_model(args, device)
     if args.resume != "":
-        model = resume_and_load(model, args.resume, device)
+        model = resume_and_load(model, args.resume)
     # Training or evaluation
     print('-------------------------------------', flush=args.flush)
     if args.mode == "single_domain":
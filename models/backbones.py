@@ -2,11 +2,36 @@ import torch
 import torchvision.ops.misc as misc
 from torchvision.models import resnet18, resnet50, resnet101
 from torchvision.models.resnet import ResNet18_Weights, ResNet50_Weights, ResNet101_Weights
-from torchvision.models._utils import IntermediateLayerGetter
 
 from utils import is_main_process
 
 
+class FrozenBatchNorm2d(misc.FrozenBatchNorm2d):
+    """
+    FrozenBatchNorm2d with the frozen statistics folded into a scale and a bias once, instead of on every forward.
+    They are folded again whenever a state dict is loaded, the only way the statistics change.
+    """
+
+    def __init__(self, num_features, eps=1e-5):
+        super().__init__(num_features, eps)
+        self.register_buffer('_scale', torch.ones(1, num_features, 1, 1), persistent=False)
+        self.register_buffer('_bias', torch.zeros(1, num_features, 1, 1), persistent=False)
+        self.fold()
+
+    @torch.no_grad()
+    def fold(self):
+        scale = self.weight * (self.running_var + self.eps).rsqrt()
+        self._scale.copy_(scale.reshape(1, -1, 1, 1))
+        self._bias.copy_((self.bias - self.running_mean * scale).reshape(1, -1, 1, 1))
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        super()._load_from_state_dict(*args, **kwargs)
+        self.fold()
+
+    def forward(self, x):
+        return x * self._scale + self._bias
+
+
 class ResNetMultiScale(torch.nn.Module):
 
     def __init__(self):
@@ -16,16 +41,46 @@ class ResNetMultiScale(torch.nn.Module):
             if 'layer2' not in name and 'layer3' not in name and 'layer4' not in name:
                 parameter.requires_grad_(False)
         self.num_outputs = 3
-        return_layers = {"layer2": "0", "layer3": "1", "layer4": "2"}
         self.strides = [8, 16, 32]
-        self.intermediate_getter = IntermediateLayerGetter(backbone, return_layers=return_layers)
+        # ResNet trunk without the classification head, kept under the same name so checkpoints still load
+        self.intermediate_getter = torch.nn.ModuleDict(
+            [(name, module) for name, module in backbone.named_children() if name not in ('avgpool', 'fc')]
+        )
 
     def get_backbone(self):
         raise NotImplementedError('This method should be implemented by subclasses.')
 
+    @torch.no_grad()
+    def fuse_conv_bn(self):
+        """
+        Fold every frozen batch norm into the convolution before it, so each pair runs as a single conv.
+        For inference only: the state dict keys of the fused backbone no longer match the checkpoints.
+        """
+        def fuse(parent, conv_name, bn_name):
+            conv, bn = getattr(parent, conv_name), getattr(parent, bn_name)
+            fused = torch.nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride, conv.padding,
+                                    conv.dilation, conv.groups, bias=True, device=conv.weight.device)
+            # Keeps the device and memory format of the original weight
+            fused.weight = torch.nn.Parameter(conv.weight * bn._scale.reshape(-1, 1, 1, 1), requires_grad=False)
+            fused.bias = torch.nn.Parameter(bn._bias.reshape(-1).clone(), requires_grad=False)
+            setattr(parent, conv_name, fused)
+            setattr(parent, bn_name, torch.nn.Identity())
+
+        for module in list(self.intermediate_getter.modules()):
+            for i in (1, 2, 3):
+                if isinstance(getattr(module, 'bn' + str(i), None), FrozenBatchNorm2d):
+                    fuse(module, 'conv' + str(i), 'bn' + str(i))
+            downsample = getattr(module, 'downsample', None)
+            if downsample is not None and isinstance(downsample[1], FrozenBatchNorm2d):
+                fuse(downsample, '0', '1')
+
     def forward(self, tensor):
-        out = self.intermediate_getter(tensor)
-        return [out['0'], out['1'], out['2']]
+        body = self.intermediate_getter
+        x = body.maxpool(body.relu(body.bn1(body.conv1(tensor))))
+        c2 = body.layer2(body.layer1(x))
+        c3 = body.layer3(c2)
+        c4 = body.layer4(c3)
+        return [c2, c3, c4]
 
 
 class ResNet18MultiScale(ResNetMultiScale):
@@ -37,7 +92,7 @@ class ResNet18MultiScale(ResNetMultiScale):
         return resnet18(
             replace_stride_with_dilation=[False, False, False],
             weights=ResNet18_Weights.DEFAULT if is_main_process() else None,
-            norm_layer=misc.FrozenBatchNorm2d
+            norm_layer=FrozenBatchNorm2d
         ), [128, 256, 512]
 
 
@@ -50,7 +105,7 @@ class ResNet50MultiScale(ResNetMultiScale):
         return resnet50(
             replace_stride_with_dilation=[False, False, False],
             weights=ResNet50_Weights.IMAGENET1K_V1 if is_main_process() else None,
-            norm_layer=misc.FrozenBatchNorm2d
+            norm_layer=FrozenBatchNorm2d
         ), [512, 1024, 2048]
 
 
@@ -63,5 +118,5 @@ class ResNet101MultiScale(ResNetMultiScale):
         return resnet101(
             replace_stride_with_dilation=[False, False, False],
             weights=ResNet101_Weights.DEFAULT if is_main_process() else None,
-            norm_layer=misc.FrozenBatchNorm2d
+            norm_layer=FrozenBatchNorm2d
         ), [512, 1024, 2048]
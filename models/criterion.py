@@ -74,8 +74,8 @@ class SetCriterion(nn.Module):
         self.coef_domain_bac = coef_domain_bac
         self.coef_mae = coef_mae
         self.alpha_focal = alpha_focal
-        self.logits_sum = [torch.zeros(1, dtype=torch.float, device=device) for _ in range(num_classes)]
-        self.logits_count = [torch.zeros(1, dtype=torch.int, device=device) for _ in range(num_classes)]
+        self.logits_sum = torch.zeros(num_classes, dtype=torch.float, device=device)
+        self.logits_count = torch.zeros(num_classes, dtype=torch.int, device=device)
         self.alpha_dt = alpha_dt
         self.gamma_dt = gamma_dt
         self.max_dt = max_dt
@@ -162,18 +162,15 @@ class SetCriterion(nn.Module):
 
     def record_positive_logits(self, logits, indices):
         idx = self._get_src_permutation_idx(indices)
-        labels = logits[idx].argmax(dim=1)
-        pos_logits = logits[idx].max(dim=1).values
-        for label, logit in zip(labels, pos_logits):
-            self.logits_sum[label] += logit
-            self.logits_count[label] += 1
+        pos_logits, labels = logits[idx].max(dim=1)
+        # Accumulate per class on device, no per-box kernels or host syncs
+        self.logits_sum.index_add_(0, labels, pos_logits.detach())
+        self.logits_count += torch.bincount(labels, minlength=self.num_classes).to(self.logits_count.dtype)
 
     def dynamic_threshold(self, thresholds):
-        for s in self.logits_sum:
-            all_reduce(s)
-        for n in self.logits_count:
-            all_reduce(n)
-        logits_means = [s.item() / n.item() if n > 0 else 0.0 for s, n in zip(self.logits_sum, self.logits_count)]
+        all_reduce(self.logits_sum)
+        all_reduce(self.logits_count)
+        logits_means = [s / n if n > 0 else 0.0 for s, n in zip(self.logits_sum.tolist(), self.logits_count.tolist())]
         assert len(logits_means) == len(thresholds)
         new_thresholds = [self.gamma_dt * threshold + (1 - self.gamma_dt) * self.alpha_dt * math.sqrt(mean)
                           for threshold, mean in zip(thresholds, logits_means)]
@@ -182,8 +179,8 @@ class SetCriterion(nn.Module):
         return new_thresholds
 
     def clear_positive_logits(self):
-        self.logits_sum = [torch.zeros(1, dtype=torch.float, device=self.device) for _ in range(self.num_classes)]
-        self.logits_count = [torch.zeros(1, dtype=torch.int, device=self.device) for _ in range(self.num_classes)]
+        self.logits_sum = torch.zeros(self.num_classes, dtype=torch.float, device=self.device)
+        self.logits_count = torch.zeros(self.num_classes, dtype=torch.int, device=self.device)
 
     @staticmethod
     def _get_src_permutation_idx(indices):
@@ -265,7 +262,7 @@ def post_process(pred_logits, pred_boxes, image_sizes, topk=100):
     topk_boxes = torch.div(topk_indexes, pred_logits.shape[2], rounding_mode='trunc')
     labels = topk_indexes % pred_logits.shape[2]
     boxes = box_cxcywh_to_xyxy(pred_boxes)
-    boxes = torch.gather(boxes, 1, topk_boxes.unsqueeze(-1).repeat(1, 1, 4))
+    boxes = boxes[torch.arange(boxes.shape[0], device=boxes.device).unsqueeze(1), topk_boxes]
     # From relative [0, 1] to absolute [0, height] coordinates
     img_h, img_w = image_sizes.unbind(1)
     scale_fct = torch.stack([img_w, img_h, img_w, img_h], dim=1)
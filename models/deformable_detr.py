@@ -1,8 +1,7 @@
 import math
-import copy
 
 import torch
-from torch.nn.functional import relu, interpolate
+from torch.nn.functional import relu
 from torch import nn
 
 
@@ -90,6 +89,7 @@ class DeformableDETR(nn.Module):
         self.input_proj = self._build_input_projections()
         # Position encoding
         self.position_encoding = position_encoding
+        self.pos_cache = {}
         # Deformable transformer
         self.query_embed = nn.Embedding(num_queries, self.hidden_dim * 2)
         self.transformer = transformer
@@ -154,31 +154,67 @@ class DeformableDETR(nn.Module):
         x2 = (1 - x).clamp(min=eps)
         return torch.log(x1 / x2)
 
+    @staticmethod
+    def resize_mask(masks, size):
+        """
+        Nearest resize of the bool padding masks, gathering rows and columns directly instead of interpolating a
+        float copy. Indices are those of interpolate(mode='nearest'): floor(i * in / out) in float32, which is a
+        plain strided view when the size divides evenly.
+        """
+        for dim, (in_size, out_size) in enumerate(zip(masks.shape[-2:], size), 1):
+            if in_size % out_size == 0:
+                masks = masks[(slice(None),) * dim + (slice(None, None, in_size // out_size),)]
+                continue
+            index = torch.arange(out_size, dtype=torch.float32, device=masks.device) * (in_size / out_size)
+            masks = masks.index_select(dim, index.floor_().long().clamp_(max=in_size - 1))
+        return masks
+
+    def cached_position_encoding(self, src, mask, max_size=32):
+        """
+        Position encoding of an unpadded feature map, computed once per size and shared by the whole batch.
+        """
+        key = (tuple(src.shape[-2:]), src.device)
+        if key not in self.pos_cache:
+            if len(self.pos_cache) >= max_size:
+                self.pos_cache.clear()
+            self.pos_cache[key] = self.position_encoding(src[:1], mask[:1])
+        return self.pos_cache[key].expand(src.shape[0], -1, -1, -1)
+
     @staticmethod
     def get_mask_list(mask_list, mask_ratio):
-        mae_mask_list = copy.deepcopy(mask_list)
-        for i in range(len(mask_list)):
-            mae_mask_list[i] = torch.rand(mask_list[i].shape).to(mask_list[i].device) < mask_ratio
-        return mae_mask_list
+        # Noise for all levels is drawn at once on the device, each position is masked independently with
+        # probability mask_ratio
+        sizes = [mask[0].numel() for mask in mask_list]
+        mae_masks = torch.rand(len(mask_list[0]), sum(sizes), device=mask_list[0].device) < mask_ratio
+        return [level_mask.reshape(mask.shape) for level_mask, mask in zip(mae_masks.split(sizes, dim=1), mask_list)]
 
-    def forward(self, images, masks, enable_mae=False, mask_ratio=0.8):
+    def forward(self, images, masks, enable_mae=False, mask_ratio=0.8, mae_only=False, unpadded=False):
         # Backbone forward
         features = self.backbone(images)
         # Prepare input features for transformer
         src_list, mask_list = [], []
         for i, feature in enumerate(features):
             src = self.input_proj[i](feature)
-            mask = interpolate(masks[None].float(), size=feature.shape[-2:]).to(torch.bool)[0]
+            mask = self.resize_mask(masks, feature.shape[-2:])
             src_list.append(src)
             mask_list.append(mask)
         if self.num_feature_levels > len(features):
             for i in range(len(features), self.num_feature_levels):
                 src = self.input_proj[i](features[-1]) if i == len(features) else self.input_proj[i](src_list[-1])
-                mask = interpolate(masks[None].float(), size=src.shape[-2:]).to(torch.bool)[0]
+                mask = self.resize_mask(masks, src.shape[-2:])
                 src_list.append(src)
                 mask_list.append(mask)
-        pos_list = [self.position_encoding(src, mask) for src, mask in zip(src_list, mask_list)]
+        if unpadded and not self.training:
+            # Without padding the position encodings only depend on the feature sizes
+            pos_list = [self.cached_position_encoding(src, mask) for src, mask in zip(src_list, mask_list)]
+        else:
+            pos_list = [self.position_encoding(src, mask) for src, mask in zip(src_list, mask_list)]
         query_embeds = self.query_embed.weight
+        use_discriminators = self.domain_pred_bac is not None and self.domain_pred_enc is not None \
+            and self.domain_pred_dec is not None
+        # Only reconstruct masked features, the detection decoder and discriminators are skipped
+        if mae_only:
+            return self.mae_forward(features, src_list, mask_list, pos_list, query_embeds, mask_ratio)
         # Transformer forward
         hs, init_reference, inter_references, _, _, inter_memory, inter_object_query = self.transformer(
             src_list,
@@ -186,20 +222,14 @@ class DeformableDETR(nn.Module):
             pos_list,
             query_embeds,
             enable_mae=False,
+            return_inter=use_discriminators,
         )
-        # Prepare outputs
-        outputs_classes, outputs_coords = [], []
-        for lvl in range(hs.shape[0]):
-            outputs_class = self.class_embed[lvl](hs[lvl])
-            reference = init_reference if lvl == 0 else inter_references[lvl - 1]
-            reference = self.inverse_sigmoid(reference)
-            tmp = self.bbox_embed[lvl](hs[lvl])
-            tmp[..., :2] += reference
-            outputs_coord = tmp.sigmoid()
-            outputs_classes.append(outputs_class)
-            outputs_coords.append(outputs_coord)
-        outputs_class = torch.stack(outputs_classes)
-        outputs_coord = torch.stack(outputs_coords)
+        # Prepare outputs, the prediction heads are shared by all decoder layers
+        references = self.inverse_sigmoid(torch.cat([init_reference[None], inter_references[:-1]]))
+        outputs_class = self.class_embed[0](hs)
+        tmp = self.bbox_embed[0](hs)
+        tmp[..., :2] += references
+        outputs_coord = tmp.sigmoid()
         out = {
             'logits_all': outputs_class,
             'boxes_all': outputs_coord,
@@ -207,20 +237,9 @@ class DeformableDETR(nn.Module):
         }
         # MAE branch
         if enable_mae:
-            assert self.transformer.mae_decoder is not None
-            mae_mask_list = self.get_mask_list(mask_list, mask_ratio)
-            mae_src_list = src_list
-            mae_output = self.transformer(
-                mae_src_list,
-                mae_mask_list,
-                pos_list,
-                query_embeds,
-                enable_mae=enable_mae,
-            )
-            out['features'] = [features[mae_idx].detach() for mae_idx in [2]]
-            out['mae_output'] = mae_output
+            out.update(self.mae_forward(features, src_list, mask_list, pos_list, query_embeds, mask_ratio))
         # Discriminators
-        if self.domain_pred_bac is not None and self.domain_pred_enc is not None and self.domain_pred_dec is not None:
+        if use_discriminators:
             outputs_domains_bac, outputs_domains_enc, outputs_domains_dec = self.discriminator_forward(
                 features, inter_memory, inter_object_query, src_list
             )
@@ -229,6 +248,22 @@ class DeformableDETR(nn.Module):
             out['domain_dec_all'] = outputs_domains_dec
         return out
 
+    def mae_forward(self, features, src_list, mask_list, pos_list, query_embeds, mask_ratio):
+        assert self.transformer.mae_decoder is not None
+        mae_mask_list = self.get_mask_list(mask_list, mask_ratio)
+        mae_src_list = src_list
+        mae_output = self.transformer(
+            mae_src_list,
+            mae_mask_list,
+            pos_list,
+            query_embeds,
+            enable_mae=True,
+        )
+        return {
+            'features': [features[mae_idx].detach() for mae_idx in [2]],
+            'mae_output': mae_output,
+        }
+
     def discriminator_forward(self, features, inter_memory, inter_object_query, src_list):
         def apply_dis(memory, discriminator):
             return discriminator(grad_reverse(memory))
@@ -148,7 +148,7 @@ class DeformableTransformer(nn.Module):
         valid_ratio = torch.stack([valid_ratio_w, valid_ratio_h], -1)
         return valid_ratio
 
-    def forward(self, srcs, masks, pos_embeds, query_embed=None, enable_mae=False):
+    def forward(self, srcs, masks, pos_embeds, query_embed=None, enable_mae=False, return_inter=True):
         # prepare input for encoder
         src_flatten = []
         mask_flatten = []
@@ -172,8 +172,9 @@ class DeformableTransformer(nn.Module):
         level_start_index = torch.cat((spatial_shapes.new_zeros((1, )), spatial_shapes.prod(1).cumsum(0)[:-1]))
         valid_ratios = torch.stack([self.get_valid_ratio(m) for m in masks], 1)
         # encoder
-        memory, inter_memory = self.encoder(src_flatten, spatial_shapes, level_start_index,
-                                            valid_ratios, lvl_pos_embed_flatten, mask_flatten)
+        # Intermediate memories and object queries are only consumed by the domain discriminators
+        memory, inter_memory = self.encoder(src_flatten, spatial_shapes, level_start_index, valid_ratios,
+                                            lvl_pos_embed_flatten, mask_flatten, return_inter and not enable_mae)
         # MAE decoder
         if enable_mae:
             assert self.mae_decoder is not None
@@ -191,7 +192,8 @@ class DeformableTransformer(nn.Module):
             enc_out_coord_un_act = self.decoder.bbox_embed[self.decoder.num_layers](output_memory) + output_proposals
             topk = self.two_stage_num_proposals
             topk_proposals = torch.topk(enc_out_class[..., 0], topk, dim=1)[1]
-            topk_coords_un_act = torch.gather(enc_out_coord_un_act, 1, topk_proposals.unsqueeze(-1).repeat(1, 1, 4))
+            batch_idx = torch.arange(bs, device=topk_proposals.device).unsqueeze(1)
+            topk_coords_un_act = enc_out_coord_un_act[batch_idx, topk_proposals]
             topk_coords_un_act = topk_coords_un_act.detach()
             reference_points = topk_coords_un_act.sigmoid()
             init_reference_out = reference_points
@@ -205,7 +207,8 @@ class DeformableTransformer(nn.Module):
             init_reference_out = reference_points
         # decoder
         hs, inter_ref, inter_object_query = self.decoder(tgt, reference_points, memory, spatial_shapes,
-                                                         level_start_index, valid_ratios, query_embed, mask_flatten)
+                                                         level_start_index, valid_ratios, query_embed, mask_flatten,
+                                                         return_inter)
         return hs, init_reference_out, inter_ref, enc_out_class, enc_out_coord_un_act, inter_memory, inter_object_query
 
 
@@ -272,15 +275,16 @@ class DeformableTransformerEncoder(nn.Module):
         reference_points = reference_points[:, :, None] * valid_ratios[:, None]
         return reference_points
 
-    def forward(self, src, spatial_shapes, level_start_index, valid_ratios, pos=None, padding_mask=None):
+    def forward(self, src, spatial_shapes, level_start_index, valid_ratios, pos=None, padding_mask=None,
+                return_inter=True):
         inter_memory = []
         output = src
         reference_points = self.get_reference_points(spatial_shapes, valid_ratios, device=src.device)
         for layer_idx, layer in enumerate(self.layers):
             output = layer(output, pos, reference_points, spatial_shapes, level_start_index, padding_mask)
-            if self.hda is not None and (layer_idx+1) in self.hda:
+            if return_inter and self.hda is not None and (layer_idx+1) in self.hda:
                 inter_memory.append(output)
-        inter_memory = torch.stack(inter_memory, dim=1)
+        inter_memory = torch.stack(inter_memory, dim=1) if return_inter else None
         return output, inter_memory
 
 
@@ -347,7 +351,7 @@ class DeformableTransformerDecoder(nn.Module):
         self.hda = hda + [num_layers]
 
     def forward(self, tgt, reference_points, src, src_spatial_shapes, src_level_start_index, src_valid_ratios,
-                query_pos=None, src_padding_mask=None):
+                query_pos=None, src_padding_mask=None, return_inter=True):
         output = tgt
         intermediate = []
         intermediate_reference_points = []
@@ -376,9 +380,9 @@ class DeformableTransformerDecoder(nn.Module):
             if self.return_intermediate:
                 intermediate.append(output)
                 intermediate_reference_points.append(reference_points)
-            if self.hda is not None and (lid+1) in self.hda:
+            if return_inter and self.hda is not None and (lid+1) in self.hda:
                 intermediate_object_query.append(output)
-        intermediate_object_query = torch.stack(intermediate_object_query, dim=1)
+        intermediate_object_query = torch.stack(intermediate_object_query, dim=1) if return_inter else None
         if self.return_intermediate:
             return torch.stack(intermediate), torch.stack(intermediate_reference_points), intermediate_object_query
         return output, reference_points, intermediate_object_query
@@ -433,16 +437,19 @@ class DeformableTransformerDecoderMAE(DeformableTransformerDecoder):
             tgt_mask = mask_flatten[:, src_level_start_index[mae_layer]: src_level_start_index[mae_layer+1]]
             tgt_mask = torch.unsqueeze(tgt_mask, -1)
             h, w, c = self.spatial_shapes[i]
-            tgt = tgt * (~tgt_mask).to(tgt.dtype) + self.mask_query.weight.\
-                expand(bs, h * w, -1) * tgt_mask.to(tgt.dtype)
+            # Select the mask query at masked positions directly on the bool mask, no float mask is materialized
+            tgt = torch.where(tgt_mask, self.mask_query.weight, tgt)
             reference_points = self.reference_points(query_pos).sigmoid()
+            # Only the last layer output is reconstructed, intermediate object queries are not collected
             hs, _, _ = super(DeformableTransformerDecoderMAE, self).forward(
                 tgt, reference_points, src,
                 src_spatial_shapes, src_level_start_index,
-                src_valid_ratios, query_pos, mask_flatten
+                src_valid_ratios, query_pos, mask_flatten,
+                return_inter=False
             )
             output = self.output_proj[i](hs)
-            mae_output.append(output.transpose(-2, -1).reshape(-1, c, h, w))
+            # (bs, h * w, c) -> (bs, c, h, w) as a channels-last view, without materializing a copy
+            mae_output.append(output.view(bs, h, w, c).permute(0, 3, 1, 2))
         return mae_output
 
 
@@ -18,6 +18,10 @@ class PositionEncodingSine(nn.Module):
         if scale is None:
             scale = 2 * math.pi
         self.scale = scale
+        # Frequencies only depend on num_pos_feats and temperature, compute them once
+        dim_t = torch.arange(num_pos_feats, dtype=torch.float32)
+        dim_t = temperature ** (2 * torch.div(dim_t, 2.0, rounding_mode='trunc') / num_pos_feats)
+        self.register_buffer('dim_t', dim_t, persistent=False)
 
     def forward(self, tensor, mask):
         not_mask = ~mask
@@ -27,10 +31,8 @@ class PositionEncodingSine(nn.Module):
             eps = 1e-6
             y_embed = (y_embed - 0.5) / (y_embed[:, -1:, :] + eps) * self.scale
             x_embed = (x_embed - 0.5) / (x_embed[:, :, -1:] + eps) * self.scale
-        dim_t = torch.arange(self.num_pos_feats, dtype=torch.float32, device=tensor.device)
-        dim_t = self.temperature ** (2 * torch.div(dim_t, 2.0, rounding_mode='trunc') / self.num_pos_feats)
-        pos_x = x_embed[:, :, :, None] / dim_t
-        pos_y = y_embed[:, :, :, None] / dim_t
+        pos_x = x_embed[:, :, :, None] / self.dim_t
+        pos_y = y_embed[:, :, :, None] / self.dim_t
         pos_x = torch.stack((pos_x[:, :, :, 0::2].sin(), pos_x[:, :, :, 1::2].cos()), dim=4).flatten(3)
         pos_y = torch.stack((pos_y[:, :, :, 0::2].sin(), pos_y[:, :, :, 1::2].cos()), dim=4).flatten(3)
         pos = torch.cat((pos_y, pos_x), dim=3).permute(0, 3, 1, 2)
@@ -2,9 +2,10 @@ import torch
 import copy
 
 
-def resume_and_load(model, ckpt_path, device):
+def resume_and_load(model, ckpt_path):
     print("Loading checkpoints from", ckpt_path)
-    checkpoints = torch.load(ckpt_path, map_location=device)
+    # Load on the host, load_state_dict copies into the model's own tensors so no second copy is made on the device
+    checkpoints = torch.load(ckpt_path, map_location='cpu')
     if 'model' in checkpoints.keys() and 'optimizer' in checkpoints.keys():
         checkpoints = convert_official_ckpt(checkpoints, model.state_dict())
     missing_keys, unexpected_keys = model.load_state_dict(checkpoints)